@@ -0,0 +1,117 @@
+"""
+Fused Numba kernels for the DICOM to PNG conversion pipeline.
+
+Numba is optional.  If it is not installed, `HAVE_NUMBA` is False and callers
+should fall back to the NumPy implementation in `dicom_to_png.py`.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+    import numba
+
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+if HAVE_NUMBA:
+
+    @njit(inline="always")
+    def _wrap(v, mask, sign_bit):
+        # Integer cast to the pixel type, wrapping like NumPy's astype() does.
+        if mask == 0:
+            return v
+        v &= mask
+        if v & sign_bit:
+            v -= mask + 1
+        return v
+
+    @njit(inline="always")
+    def _mapped_value(x, slope, intercept, lut, first_value, mask, sign_bit):
+        # Rescale, casting back to the pixel type as `rescale_image` does:
+        v = _wrap(int(x * slope + intercept), mask, sign_bit)
+        # Then look up in the LUT (if any), clamping to the first/last entry:
+        if lut.shape[0] > 0:
+            i = min(max(v - first_value, 0), lut.shape[0] - 1)
+            v = _wrap(int(lut[i]), mask, sign_bit)
+        return v
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _dicom_to_u8(pix, slope, intercept, lut, first_value, mask, sign_bit):
+        rows, cols = pix.shape
+        # Pass 1: min/max of the rescaled, LUT-mapped values.
+        v_min = _mapped_value(
+            pix[0, 0], slope, intercept, lut, first_value, mask, sign_bit
+        )
+        v_max = v_min
+        for r in prange(rows):
+            for c in range(cols):
+                v = _mapped_value(
+                    pix[r, c], slope, intercept, lut, first_value, mask, sign_bit
+                )
+                v_min = min(v_min, v)
+                v_max = max(v_max, v)
+        # Pass 2: recompute each value and scale it into 0-255.
+        out = np.empty((rows, cols), dtype=np.uint8)
+        scale = 255.0 / (v_max - v_min) if v_max > v_min else 0.0
+        for r in prange(rows):
+            for c in range(cols):
+                v = _mapped_value(
+                    pix[r, c], slope, intercept, lut, first_value, mask, sign_bit
+                )
+                out[r, c] = np.uint8((v - v_min) * scale)
+        return out
+
+
+def cast_masks(dtype):
+    """
+    Return the `(mask, sign_bit)` the kernels use to mimic casting intermediate
+    values back to the integer pixel type `dtype`; `mask` is 0 for 64-bit types,
+    which need no wrapping.
+    """
+    bits = np.dtype(dtype).itemsize * 8
+    if bits >= 64:
+        return 0, 0
+    mask = (1 << bits) - 1
+    sign_bit = 1 << (bits - 1) if np.dtype(dtype).kind == "i" else 0
+    return mask, sign_bit
+
+
+def dicom_to_u8(pix, slope, intercept, lut, first_value):
+    """
+    Apply rescale slope/intercept and LUT to the 2-D integer image `pix`, then
+    normalize it to 8-bit greyscale, all in a single fused kernel.  Pass an empty
+    `lut` if there is no LUT to apply.
+    """
+    pix = np.ascontiguousarray(pix)
+    mask, sign_bit = cast_masks(pix.dtype)
+    return _dicom_to_u8(
+        pix, float(slope), float(intercept), lut, int(first_value), mask, sign_bit
+    )
+
+
+def set_num_threads(num_threads):
+    """
+    Limit the number of threads the parallel kernel uses in the calling thread (by
+    default it uses one per core).  Does nothing if Numba is unavailable.
+    """
+    if HAVE_NUMBA:
+        numba.set_num_threads(num_threads)
+
+
+def warmup():
+    """
+    Compile the kernel for the common pixel types so the first conversion isn't
+    delayed by JIT compilation.  Does nothing if Numba is unavailable.
+    """
+    if not HAVE_NUMBA:
+        return
+    lut = np.zeros(2, dtype=np.int64)
+    lut.setflags(write=False)  # cached LUT arrays are read-only
+    for pix_type in (np.uint16, np.int16):
+        for writeable in (True, False):  # memory-mapped images are read-only
+            pix = np.zeros((2, 2), dtype=pix_type)
+            pix.setflags(write=writeable)
+            dicom_to_u8(pix, 1.0, 0.0, np.zeros(0, dtype=pix_type), 0)
+            dicom_to_u8(pix, 1.0, 0.0, lut, 0)
@@ -4,8 +4,16 @@ Convert DICOM files to corresponding PNG files.
 NOTE:  Only works with DICOM files containing a single
 layer!
 """
-import sys, os, collections, toml, asyncio, hashlib, time, platform, queue
-import numpy as np, png, pydicom, multiprocessing
+import sys, os, collections, toml, asyncio, hashlib, platform, queue
+import functools, mmap, struct
+import numpy as np, png, pydicom, multiprocessing, concurrent.futures
+import conversion_kernels, gpu_pipeline
+
+try:
+    import cv2  # optional: faster (C) PNG encoder
+except ImportError:
+    cv2 = None
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtWidgets import (
@@ -18,7 +26,7 @@ from PyQt5.QtWidgets import (
     QPlainTextEdit,
     QFileDialog,
 )
-from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot, QSize, QTimer
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QSize, QTimer
 
 
 def trap_exc_during_debug(*args):
@@ -48,7 +56,11 @@ def readConfigFile(path=None):
 def initializeConfigFile(path=None):
     config_file = getConfigFileName(path)
     default_config = {
-        "output_path": os.path.join(os.path.expanduser("~"), "png_files_from_dicom")
+        "output_path": os.path.join(os.path.expanduser("~"), "png_files_from_dicom"),
+        # zlib level 0-9; 1 is much faster than the usual 6 for a slightly larger file.
+        "png_compression_level": 1,
+        # Convert pixels on a CUDA GPU (needs CuPy); uses the CPU if none is found.
+        "use_gpu": False,
     }
     saveConfigToFile(default_config)
 
@@ -69,61 +81,84 @@ def rescale_image(img, hdr):
         return (img, hdr)
     if type(hdr) == type([]):
         hdr = hdr[0]
-    img = np.array(img)
+    img = np.asarray(img)
     img_type = img.dtype
     # Get the scaling info
     rescale_slope = float(getattr(hdr, "RescaleSlope", 1))
     rescale_intercept = float(getattr(hdr, "RescaleIntercept", 0))
-    # Re-Scale
-    img = img.astype(np.float64) * rescale_slope + rescale_intercept
-    img = img.astype(img_type)
+    # Re-Scale (float32 is exact enough for 8/16-bit pixels; keep float64 for wider)
+    scratch_type = np.float32 if img_type.itemsize <= 2 else np.float64
+    scratch = np.empty(img.shape, dtype=scratch_type)
+    np.multiply(img, scratch_type(rescale_slope), out=scratch, dtype=scratch_type)
+    np.add(scratch, scratch_type(rescale_intercept), out=scratch)
+    img = scratch.astype(img_type)
     # Update the header
     setattr(hdr, "RescaleSlope", 1.0)
     setattr(hdr, "RescaleIntercept", 0.0)
     return (img, hdr)
 
 
-def apply_LUT(img, hdr):
+@functools.lru_cache(maxsize=16)
+def make_LUT_array(lut_data):
     """
-    Apply LUT specified in header to the image, if the header specifies one.
-    Specification:
-    http://dicom.nema.org/medical/dicom/2017a/output/chtml/part03/sect_C.11.2.html#sect_C.11.2.1.1
+    Return the LUT values in the tuple `lut_data` as an int64 array, which holds any
+    LUT entry whatever the sign of the descriptor's first value (the result is cast
+    to the pixel type after the lookup).
+    Results are cached, since the slices of a series usually share the same LUT;
+    the returned array is shared, so it is read-only.
+    """
+    lut_array = np.asarray(lut_data, dtype=np.int64)
+    lut_array.flags.writeable = False
+    return lut_array
+
+
+def get_LUT(hdr):
+    """
+    Return the first LUT specified in the header as `(lut_array, first_value)`, or
+    None if the header doesn't specify one.  `first_value` is None if the LUT
+    descriptor doesn't give a usable one.
     """
     lut_seq = getattr(hdr, "VOILUTSequence", None)
     if lut_seq is None:
-        # print("No LUT for image {}".format(generate_unique_filename(hdr)))
-        return img, hdr
+        return None
     # Use the first available LUT:
     lut_desc = getattr(lut_seq[0], "LUTDescriptor", None)
     lut_data = getattr(lut_seq[0], "LUTData", None)
     if lut_desc is None or lut_data is None:
-        return img, hdr
+        return None
     try:
         first_value = int(lut_desc[1])
     except:
-        pass
-    bit_depth = int(lut_desc[2])
-    sign_selector = "u" if type(first_value) == int and first_value >= 0 else ""
-    type_selector = 8
-    while type_selector < bit_depth and type_selector < 64:
-        type_selector *= 2
-    orig_type = img.dtype
+        first_value = None
+    lut_array = make_LUT_array(tuple(lut_data))
+    return lut_array, first_value
 
-    img = np.round(img)
 
-    if type(first_value) != int:
-        first_value = img.min()
+def apply_LUT(img, hdr):
+    """
+    Apply LUT specified in header to the image, if the header specifies one.
+    Specification:
+    http://dicom.nema.org/medical/dicom/2017a/output/chtml/part03/sect_C.11.2.html#sect_C.11.2.1.1
+    """
+    lut = get_LUT(hdr)
+    if lut is None:
+        # print("No LUT for image {}".format(generate_unique_filename(hdr)))
+        return img, hdr
+    lut_array, first_value = lut
+    orig_type = img.dtype
 
-    LUT = {
-        int(v): lut_data[j]
-        for j, v in [(i, first_value + i) for i in range(len(lut_data))]
-    }
+    if img.dtype.kind == "f":
+        img = np.round(img)
+
+    if first_value is None:
+        first_value = int(img.min())
 
-    img2 = np.array(img)
-    img2 = img2.astype("{}int{}".format(sign_selector, type_selector))
-    img2[img < first_value] = first_value
-    img2 = np.vectorize(lambda x: LUT[int(x)])(img2)
-    img2[img >= (first_value + len(lut_data))] = lut_data[-1]
+    # Offset into the LUT; values outside its range map to the first/last entry.
+    idx = np.empty(img.shape, dtype=np.intp)
+    np.subtract(img, first_value, out=idx, dtype=np.intp, casting="unsafe")
+    np.clip(idx, 0, len(lut_array) - 1, out=idx)
+    img2 = np.empty(img.shape, dtype=lut_array.dtype)
+    np.take(lut_array, idx, out=img2)
 
     del hdr.VOILUTSequence
 
@@ -164,28 +199,226 @@ def apply_window(img, hdr):
     return img_out, hdr
 
 
+# Size of the float32 scratch block used by `normalize_to_uint8`; small enough to
+# stay in (L2) cache while each block is scaled.
+NORMALIZE_BLOCK_BYTES = 256 * 1024
+
+
+def normalize_to_uint8(img):
+    """
+    Linearly scale image intensities to the range 0-255 and convert to 8-bit
+    unsigned integers.  After finding the min and max, the image is scaled a block
+    of rows at a time in a small float32 scratch buffer, so each block is read from
+    memory once and stays in cache for all of the steps.
+    """
+    img_min, img_max = img.min(), img.max()
+    img_range = float(img_max) - float(img_min)
+    out = np.empty(img.shape, dtype=np.uint8)
+    row_size = img.size // img.shape[0]
+    block_rows = max(1, NORMALIZE_BLOCK_BYTES // (row_size * 4))
+    scratch = np.empty((block_rows,) + img.shape[1:], dtype=np.float32)
+    for start in range(0, img.shape[0], block_rows):
+        rows = img[start : start + block_rows]
+        block = scratch[: rows.shape[0]]
+        np.subtract(rows, img_min, out=block, dtype=np.float32)
+        if img_range > 0:
+            block /= img_range
+            block *= 255.0
+        np.copyto(out[start : start + block_rows], block, casting="unsafe")
+    return out
+
+
+def normalize_batch_to_uint8(batch):
+    """
+    Like `normalize_to_uint8`, but for a stack of images `batch[N, ...]`, each of
+    which is scaled by its own min and max.  The whole stack is handled by a few
+    NumPy calls rather than a few calls per image.
+    """
+    axes = tuple(range(1, batch.ndim))
+    batch_min = batch.min(axis=axes, keepdims=True)
+    batch_max = batch.max(axis=axes, keepdims=True)
+    batch_range = (batch_max.astype(np.float64) - batch_min).astype(np.float32)
+    batch_range[batch_range == 0] = 1.0  # Constant images are all 0 anyway.
+    scaled = np.subtract(batch, batch_min, dtype=np.float32)
+    scaled /= batch_range
+    scaled *= 255.0
+    return scaled.astype(np.uint8)
+
+
 def read_dicom_raw(file_path):
     dicom = pydicom.read_file(file_path)
     img = dicom.pixel_array
     return img, dicom
 
 
+# Uncompressed transfer syntaxes that `read_dicom_fast` can read pixels from
+# directly, mapped to whether they use implicit VR:
+NATIVE_TRANSFER_SYNTAXES = {
+    pydicom.uid.ImplicitVRLittleEndian: True,
+    pydicom.uid.ExplicitVRLittleEndian: False,
+}
+
+
+def read_dicom_fast(file_path):
+    """
+    Read a DICOM file, returning its image and header like `read_dicom_raw`.
+    For uncompressed, little-endian, single-frame greyscale images the file is
+    memory-mapped and the image is a read-only view of the pixel data in the map,
+    so nothing is copied and the OS only pages in what is used.  Any other file
+    falls back to `read_dicom_raw`.
+    """
+    with open(file_path, "rb") as fin:
+        try:
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file; let pydicom report the problem.
+            return read_dicom_raw(file_path)
+    # The image will keep the map alive (and it is closed once the image is freed).
+    hdr = pydicom.dcmread(mm, stop_before_pixels=True)
+    transfer_syntax = getattr(hdr.file_meta, "TransferSyntaxUID", None)
+    bits_allocated = getattr(hdr, "BitsAllocated", None)
+    bits_stored = getattr(hdr, "BitsStored", bits_allocated)
+    signed = getattr(hdr, "PixelRepresentation", 0) == 1
+    if (
+        transfer_syntax not in NATIVE_TRANSFER_SYNTAXES
+        or bits_allocated not in (8, 16, 32)
+        or (signed and bits_stored != bits_allocated)
+        or getattr(hdr, "SamplesPerPixel", 1) != 1
+        or int(getattr(hdr, "NumberOfFrames", 1) or 1) != 1
+    ):
+        mm.close()
+        return read_dicom_raw(file_path)
+
+    # The map is now positioned at the start of the Pixel Data element:
+    implicit_vr = NATIVE_TRANSFER_SYNTAXES[transfer_syntax]
+    element_start = mm.tell()
+    pixel_offset = element_start + (8 if implicit_vr else 12)
+    dtype = np.dtype("<{}{}".format("i" if signed else "u", bits_allocated // 8))
+    count = hdr.Rows * hdr.Columns
+    if pixel_offset + count * dtype.itemsize > len(mm):
+        mm.close()
+        return read_dicom_raw(file_path)
+    group, element = struct.unpack_from("<HH", mm, element_start)
+    length = struct.unpack_from("<I", mm, pixel_offset - 4)[0]
+    if (group, element) != (0x7FE0, 0x0010) or length < count * dtype.itemsize:
+        mm.close()
+        return read_dicom_raw(file_path)
+    img = np.frombuffer(mm, dtype=dtype, count=count, offset=pixel_offset)
+    img = img.reshape(hdr.Rows, hdr.Columns)
+    return img, hdr
+
+
 def read_dicom(file_path):
-    img, hdr = read_dicom_raw(file_path)
+    img, hdr = read_dicom_fast(file_path)
     img, hdr = rescale_image(img, hdr)
     img, hdr = apply_LUT(img, hdr)
     img, hdr = apply_window(img, hdr)
     return img, hdr
 
 
+def read_dicom_for_png(file_path, use_gpu=False):
+    """
+    Read a DICOM file and prepare its image for `write_png`.  When possible,
+    rescale, LUT, and normalization to 8-bit greyscale are done in one fused kernel
+    (on the GPU if `use_gpu` is set and one is available, otherwise with Numba).
+    Otherwise the image is only rescaled, LUT-mapped, and windowed as `read_dicom`
+    does, and the caller must still normalize it with `normalize_to_uint8` (or
+    several at once with `normalize_batch_to_uint8`).
+    Returns `(img, hdr, normalized)`, where `normalized` tells whether `img` has
+    already been converted to 8-bit greyscale.
+    """
+    img, hdr = read_dicom_fast(file_path)
+    lut = get_LUT(hdr)
+    if (
+        img.ndim == 2
+        and img.dtype.kind in "iu"
+        and getattr(hdr, "WindowCenter", None) is None
+        and (lut is None or lut[1] is not None)
+    ):
+        lut_array, first_value = lut if lut is not None else (np.zeros(0, img.dtype), 0)
+        args = (
+            img,
+            float(getattr(hdr, "RescaleSlope", 1)),
+            float(getattr(hdr, "RescaleIntercept", 0)),
+            lut_array,
+            first_value,
+        )
+        if use_gpu and gpu_pipeline.available():
+            try:
+                return gpu_pipeline.dicom_to_u8(*args), hdr, True
+            except Exception:
+                pass  # e.g. out of GPU memory; convert it on the CPU instead
+        if conversion_kernels.HAVE_NUMBA:
+            return conversion_kernels.dicom_to_u8(*args), hdr, True
+    img, hdr = rescale_image(img, hdr)
+    img, hdr = apply_LUT(img, hdr)
+    img, hdr = apply_window(img, hdr)
+    return img, hdr, False
+
+
+def write_png(output_file, img, compression_level=1):
+    """
+    Write the 8-bit greyscale image `img` to `output_file` in PNG format, using the
+    given zlib `compression_level` (0-9).  Uses OpenCV's encoder if it is installed
+    (falling back if it fails), otherwise pypng.
+    """
+    if img.ndim != 2:
+        raise ValueError(
+            "expected a single-channel greyscale image, got shape {}".format(img.shape)
+        )
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    if cv2 is not None:
+        try:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, compression_level]
+            if cv2.imwrite(output_file, img, params):
+                return
+        except cv2.error:
+            pass
+    writer = png.Writer(
+        img.shape[1], img.shape[0], greyscale=True, compression=compression_level
+    )
+    with open(output_file, "wb") as fout:
+        writer.write_array(fout, img.reshape(-1))
+
+
+# Extensions of files picked up when a folder is added ("" is no extension):
+DICOM_EXTENSIONS = frozenset([".dcm", ".dicom", ""])
+
+
+def find_dicom_files(dirname):
+    """
+    Generate the paths of all DICOM files in the folder tree rooted at `dirname`.
+    Uses `os.scandir` so that each entry only needs a single system call.
+    """
+    stack = [dirname]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue  # Unreadable folders are skipped, as os.walk() would.
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif (
+                    entry.is_file()
+                    and os.path.splitext(entry.name)[1].lower() in DICOM_EXTENSIONS
+                ):
+                    yield entry.path
+
+
 def path_to_list(file_path):
-    if file_path == "" or file_path == os.path.sep:
-        return []
-    rest, last = os.path.split(file_path)
-    # Check to see if we have hit a "root" (or "drive"), bail out if so.
-    if rest == file_path:
-        return [rest]
-    return path_to_list(rest) + [last] if last != "" else path_to_list(rest)
+    drive, rest = os.path.splitdrive(file_path)
+    seps = os.path.sep + (os.path.altsep or "")
+    relative = rest.lstrip(seps)
+    if os.path.altsep:
+        relative = relative.replace(os.path.altsep, os.path.sep)
+    parts = [part for part in relative.split(os.path.sep) if part != ""]
+    # Keep the "root" (or "drive") as written as the first item, unless it is just
+    # a bare separator.
+    root = drive + rest[: len(rest) - len(relative)]
+    if root != "" and root != os.path.sep:
+        parts.insert(0, root)
+    return parts
 
 
 def abbreviate_path(file_path, length=2):
@@ -231,10 +464,143 @@ def generate_unique_filename(dicom_header, extension=".dcm"):
     return "{}_{}{}".format(patient_id, instance_hash, extension)
 
 
+def prefetch_file(file_path, chunk_size=1 << 20):
+    """
+    Read through `file_path` so that it is in the OS page cache by the time it is
+    converted, letting disk (or network) reads overlap with conversion work.
+    Errors are ignored here; the conversion itself will report them.
+    """
+    buffer = bytearray(chunk_size)
+    try:
+        with open(file_path, "rb", buffering=0) as fin:
+            while fin.readinto(buffer):
+                pass
+    except OSError:
+        pass
+
+
+def save_png(img, hdr, output_path, compression_level=1):
+    """
+    Save the 8-bit image `img` as a PNG in `output_path`, named by the DICOM header.
+    """
+    # Other worker processes may be creating the folder at the same time:
+    os.makedirs(output_path, exist_ok=True)
+
+    # Make a unique filename based on the DICOM header info:
+    output_file = generate_unique_filename(hdr, ".png")
+    output_file = os.path.join(output_path, output_file)
+
+    # Write in PNG format:
+    write_png(output_file, img, compression_level)
+
+
+def init_worker(gpu_slots):
+    """
+    Initializer for the conversion worker processes.  Each worker compiles the
+    conversion kernel, and takes one of the shared `gpu_slots` (a
+    `multiprocessing.Value`) if any are left; workers that don't get one never touch
+    the GPU, so only a few CUDA contexts are created.
+    """
+    # There is already a worker per core, so each one runs the kernel on one thread:
+    conversion_kernels.set_num_threads(1)
+    with gpu_slots.get_lock():
+        got_slot = gpu_slots.value > 0
+        if got_slot:
+            gpu_slots.value -= 1
+    gpu_pipeline.set_enabled(got_slot)
+    conversion_kernels.warmup()
+
+
+def convert_one(file_path, output_path, compression_level=1, use_gpu=False):
+    """
+    Performs the conversion of one file from DICOM to PNG, applying any LUT that is
+    embedded.  `compression_level` is the zlib level used for the PNG, and
+    `use_gpu` allows the pixel conversion to run on a CUDA GPU if one is available.
+    Returns a tuple `(ok, msg)` where `msg` is a message for the user.
+    This is a plain function so that it can be run in a worker process.
+    """
+    return convert_many([file_path], output_path, compression_level, use_gpu)[0]
+
+
+# Images are only normalized together (see `convert_many`) while the stack holds at
+# most this many pixels; bigger images are each normalized on their own, at once.
+MAX_STACK_PIXELS = 1 << 22
+
+
+def convert_many(file_paths, output_path, compression_level=1, use_gpu=False):
+    """
+    Like `convert_one`, but converts a list of files, returning a list with an
+    `(ok, msg)` tuple for each.  The next file is read ahead on a thread while the
+    current one is converted, so the disk isn't idle during conversion.  Small
+    images that still need to be normalized and share a shape and type (e.g. slices
+    of a series) are normalized together as one stack, to save NumPy's per-call
+    overhead on each of them.
+    """
+    results = [None] * len(file_paths)
+    to_normalize = collections.defaultdict(list)  # (shape, dtype): [(i, img, hdr)]
+
+    def save(i, img, hdr):
+        try:
+            save_png(img, hdr, output_path, compression_level)
+            results[i] = True, None
+        except Exception as e:
+            results[i] = False, e
+
+    def normalize_group(group):
+        try:
+            if len(group) == 1:
+                imgs = [normalize_to_uint8(group[0][1])]
+            else:
+                imgs = normalize_batch_to_uint8(np.stack([img for _, img, _ in group]))
+        except Exception as e:
+            for i, _, _ in group:
+                results[i] = False, e
+            return
+        for (i, _, hdr), img in zip(group, imgs):
+            save(i, img, hdr)
+
+    io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    for i, file_path in enumerate(file_paths):
+        if i + 1 < len(file_paths):
+            io_pool.submit(prefetch_file, file_paths[i + 1])
+        try:
+            img, hdr, normalized = read_dicom_for_png(file_path, use_gpu)
+        except Exception as e:
+            results[i] = False, e
+            continue
+        if normalized:
+            save(i, img, hdr)
+        elif img.size > MAX_STACK_PIXELS // 4:
+            # Too big to be worth holding on to; normalize it right away.
+            normalize_group([(i, img, hdr)])
+        else:
+            key = (img.shape, img.dtype)
+            to_normalize[key].append((i, img, hdr))
+            if len(to_normalize[key]) * img.size >= MAX_STACK_PIXELS:
+                normalize_group(to_normalize.pop(key))
+    io_pool.shutdown()
+    for group in to_normalize.values():
+        normalize_group(group)
+
+    messages = []
+    for file_path, (ok, error) in zip(file_paths, results):
+        basename = os.path.basename(file_path)
+        if ok:
+            messages.append((True, '[OK]: Finished converting "{}"'.format(basename)))
+        else:
+            msg = '[FAIL]: Failed converting "{}" ({})'.format(basename, error)
+            messages.append((False, msg))
+    return messages
+
+
 class ConverterWindow(QMainWindow):
     NUM_THREADS = multiprocessing.cpu_count()
+    LOG_FLUSH_INTERVAL = 250  # milliseconds between log updates
+    LOG_FLUSH_MAX_LINES = 1000  # most lines added to the log per update
+    MAX_BATCH_SIZE = 16  # most files sent to a worker process at once
+    MAX_GPU_WORKERS = 1  # most worker processes that may use the GPU
 
-    sig_abort_workers = pyqtSignal()
+    sig_job_done = pyqtSignal(object)  # Future of a conversion that has finished
 
     def __init__(self):
         self.platform = platform.system().lower()
@@ -247,8 +613,11 @@ class ConverterWindow(QMainWindow):
         # keep it large enough to be an easy target
         self.setMinimumSize(QSize(400, 600))
         self.responseLines = collections.deque(maxlen=20)
-        self.queue = queue.Queue()
-        self.working = {}
+        # Conversions run in a long-lived process pool; `futures` maps each
+        # conversion still in progress to the task info for its files.
+        self.pool = self.startPool()
+        self.futures = {}
+        self.sig_job_done.connect(self.onJobDone)
         self.convertedCount = 0
         self.didAbort = False
 
@@ -299,6 +668,13 @@ class ConverterWindow(QMainWindow):
         self.log.setReadOnly(True)
         gridLayout.addWidget(self.log, 3, 0, 1, 4)
 
+        # Log messages are queued (from any thread) and added to the log in batches,
+        # so that big conversion jobs don't flood the GUI with updates:
+        self._log_queue = queue.SimpleQueue()
+        self._log_timer = QTimer(self)
+        self._log_timer.timeout.connect(self._flush_log)
+        self._log_timer.start(self.LOG_FLUSH_INTERVAL)
+
         self.setStatusBar("Output Folder: {}".format(abbreviate_path(self.outputDir)))
 
     @pyqtSlot()
@@ -307,11 +683,48 @@ class ConverterWindow(QMainWindow):
         self.exitButton.setEnabled(False)
         self.setStatusBar("Exiting....")
         self.abortWorkers()
+        self.pool.shutdown(wait=False)
+        self._flush_log()
         app.quit()
 
+    def startPool(self):
+        """
+        Start and return a new pool of conversion worker processes.  Workers are
+        spawned rather than forked, since forking this (multi-threaded Qt) process
+        is unsafe; each one compiles the conversion kernel as it starts.
+        """
+        mp_context = multiprocessing.get_context("spawn")
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.NUM_THREADS,
+            mp_context=mp_context,
+            initializer=init_worker,
+            initargs=(mp_context.Value("i", self.MAX_GPU_WORKERS),),
+        )
+
+    def restartPool(self):
+        """
+        Replace the pool after one of its workers died (e.g. killed for running out
+        of memory), which leaves a `ProcessPoolExecutor` unusable.
+        """
+        self.addResponse("[ERROR]: A conversion process died; starting new ones.")
+        self.pool.shutdown(wait=False)
+        self.pool = self.startPool()
+
     def addResponse(self, msg):
-        self.log.appendPlainText(msg)
-        print(msg)
+        self._log_queue.put(msg)
+
+    @pyqtSlot()
+    def _flush_log(self):
+        batch = []
+        try:
+            while len(batch) < self.LOG_FLUSH_MAX_LINES:
+                batch.append(self._log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if len(batch) > 0:
+            text = "\n".join(batch)
+            self.log.appendPlainText(text)
+            print(text)
 
     def setResponse(self, msg):
         self.setStatusBar(msg)
@@ -416,60 +829,38 @@ class ConverterWindow(QMainWindow):
         self.stopAndExit()
         event.ignore()
 
-    def startThreads(self):
-        global conversion_serial
-        self.indicateThreadsRunning(True)
-        self.setStatusBar("Working...")
-        if self.queue.empty():
-            self.setStatusBar(
-                "{} Files converted.  You can add more, or exit.".format(
-                    self.convertedCount
+    @pyqtSlot(object)
+    def onJobDone(self, future):
+        info = self.futures.pop(future)
+        if (
+            not future.cancelled()
+            and isinstance(future.exception(), BrokenProcessPool)
+            and info["pool"] is self.pool
+        ):
+            # Its conversions fail (below), but later ones need a working pool:
+            self.restartPool()
+        if future.cancelled():
+            results = [
+                (False, '[FAIL]: Conversion cancelled "{}"'.format(basename))
+                for basename in info["basenames"]
+            ]
+        elif future.exception() is not None:
+            results = [
+                (
+                    False,
+                    '[FAIL]: Failed converting "{}" ({})'.format(
+                        basename, future.exception()
+                    ),
                 )
-            )
-            self.indicateThreadsRunning(False)
-            # self.setStatusBar("Ready.")
-        try:
-            while (not self.queue.empty()) and (len(self.working) < self.NUM_THREADS):
-                info = self.queue.get_nowait()
-                # self.addResponse('Starting conversion for "{}".'.format(info['basename']))
-                conversion_serial += 1
-                worker_id = conversion_serial
-                worker = ConversionWorker(worker_id, info)
-                thread = QThread()
-                thread.setObjectName("{}".format(id))
-                self.working[worker_id] = (
-                    info,
-                    worker,
-                    thread,
-                    id,
-                )  # need to store worker and thread too otherwise will be gc'd
-                worker.moveToThread(thread)
-
-                # get progress messages from worker:
-                worker.sig_done.connect(self.onWorkerDone)
-                worker.sig_msg.connect(self.addResponse)
-
-                # in case we need to stop the worker:
-                self.sig_abort_workers.connect(worker.abort)
-
-                # start the worker:
-                thread.started.connect(worker.doConversion)
-                thread.start()  # this will emit 'started' and start thread's event loop
-        except queue.Empty:
-            pass  # When the queue is empty, we just stop creating threads.
-
-    @pyqtSlot(int, bool)
-    def onWorkerDone(self, worker_id, error):
-        thread = self.working[worker_id][2]
-        # self.addResponse('Finished converting "{}" (error? {})'.format(self.working[worker_id][0]['basename'], error))
-        if thread.isRunning():
-            thread.quit()  # ask the thread to quit.
-            thread.wait()  # <- so you need to wait for it to *actually* quit
-        del self.working[worker_id]  # Now you can delete it without error.
-        self.queue.task_done()
-        if not error:
-            self.convertedCount += 1
-        if len(self.working) == 0 and self.queue.empty():
+                for basename in info["basenames"]
+            ]
+        else:
+            results = future.result()
+        for ok, msg in results:
+            self.addResponse(msg)
+            if ok:
+                self.convertedCount += 1
+        if len(self.futures) == 0:
             if not self.didAbort:
                 self.addResponse("[DONE]: All conversions finished.")
             else:
@@ -477,19 +868,15 @@ class ConverterWindow(QMainWindow):
                 self.didAbort = False
             self.setStatusBar("Ready.")
             self.indicateThreadsRunning(False)
-        if not self.queue.empty():
-            self.indicateThreadsRunning(True)
-            self.setStatusBar("Working...")
-            self.startThreads()
 
     @pyqtSlot()
     def abortWorkers(self):
         self.stopButton.setEnabled(False)
         self.addResponse("Stopping in-progress conversions...")
         self.didAbort = True
-        with self.queue.mutex:
-            self.queue.queue.clear()
-            self.sig_abort_workers.emit()
+        # Conversions that have already started will run to completion.
+        for future in list(self.futures):
+            future.cancel()
 
     def processNewItems(self, new_items):
         converting = set()
@@ -501,18 +888,15 @@ class ConverterWindow(QMainWindow):
             dir_files = []
             dirname = win_safe_path(dirname)
             if os.path.isdir(dirname):
-                # Fancy list comprehension for folder walk from https://stackoverflow.com/a/18394205
-                dir_files = [
-                    os.path.join(dp, f)
-                    for dp, dn, filenames in os.walk(dirname)
-                    for f in filenames
-                    if os.path.splitext(f)[1] in [".dcm", ".dicom", ""]
-                ]
+                dir_files = list(find_dicom_files(dirname))
             files.extend(dir_files)
         if len(files) > 0:
             self.addResponse("Processing {} new files...".format(len(files)))
         else:
             self.addResponse("No new DICOM files were found.".format(len(files)))
+        compression_level = int(self.config.get("png_compression_level", 1))
+        use_gpu = bool(self.config.get("use_gpu", False))
+        new_files = []
         for fname in files:
             if fname is None:
                 continue
@@ -521,122 +905,40 @@ class ConverterWindow(QMainWindow):
                 self.setResponse("[ERROR]: {} added more than once.".format(fname))
                 self.abortWorkers()
                 sys.exit(1)
-            job_id = hashlib.sha1(
-                "{}{}".format(fname, time.process_time()).encode("ascii")
-            ).hexdigest()
-            self.queue.put(
-                {
-                    "basename": os.path.basename(fname),
-                    "file_path": fname,
-                    "output_path": self.outputDir,
-                }
-            )
+            new_files.append(fname)
             converting.add(fname)
-
-        self.startThreads()
-
-
-class ConversionWorker(QObject):
-    """
-    Framework was modelled after this example: https://stackoverflow.com/a/41605909
-    Must derive from QObject in order to emit signals, connect slots to other signals, and operate in a QThread.
-    """
-
-    sig_done = pyqtSignal(int, bool)  # worker id: emitted at end of work()
-    sig_msg = pyqtSignal(str)  # message to be shown to user
-
-    class AbortConversion(Exception):
-        pass
-
-    def __init__(self, id, info):
-        super().__init__()
-        self.id = id
-        self.abort_requested = False
-        self.task_info = info
-
-    def checkPoint(self, info, msg=None):
-        """
-        See if work can continue; raises an AbortConversion exception if we need to stop.
-        """
-        msg_suffix = ""
-        thread_id = int(QThread.currentThreadId())
-        if msg is not None:
-            msg_suffix = ": {}".format(msg)
-        msg = 'Conversion cancelled "{}" {}'.format(info["basename"], msg_suffix)
-        # check if we need to abort the loop; need to process events to receive signals;
-        app.processEvents()  # this could cause change to self.abort
-        if self.abort_requested:
-            raise self.AbortConversion(msg)
-
-    @pyqtSlot()
-    def doConversion(self):
-        """
-        Performs the conversion from DICOM to PNG, applying any LUT that is embedded.
-        """
-        thread_id = int(QThread.currentThreadId())  # cast to int() is necessary
-        error_flag = False
-        # thread_name = QThread.currentThread().objectName()
-        # print("Worker: id {}  name {}".format(thread_id, thread_name))
-
-        info = self.task_info
-        file_path = info["file_path"]
-        output_path = info["output_path"]
-        basename = info["basename"]
-        self.sig_msg.emit('Starting conversion for "{}"'.format(basename, thread_id))
-        try:
-            self.checkPoint(info, "[0]")
-            img, hdr = read_dicom(file_path)
-            self.checkPoint(info, "[1]")
-
-            if not os.path.isdir(output_path):
-                os.makedirs(output_path)
-
-            # Make a unique filename based on the DICOM header info:
-            output_file = generate_unique_filename(hdr, ".png")
-            output_file = os.path.join(output_path, output_file)
-
-            self.checkPoint(info, "[2]")
-
-            # Convert to greyscale in range 0-255
-            img = img.astype(float)
-            img -= img.min()
-            img /= img.max()
-            img *= 255.0
-
-            # Convert to 8-bit unsigned int:
-            img = img.astype("uint8")
-            shape = img.shape
-
-            self.checkPoint(info, "[3]")
-
-            # Write in PNG format:
-            writer = png.Writer(shape[1], shape[0], greyscale=True)
-            with open(output_file, "wb") as fout:
-                writer.write(fout, img)
-            self.sig_msg.emit('[OK]: Finished converting "{}"'.format(basename))
-        except self.AbortConversion as e:
-            self.sig_msg.emit("[FAIL]: {}".format(str(e)))
-            error_flag = True
-        except Exception as e:
-            self.sig_msg.emit('[FAIL]: Failed converting "{}" ({})'.format(basename, e))
-            error_flag = True
-
-        self.sig_done.emit(self.id, error_flag)
-
-    def abort(self):
-        if not self.abort_requested:
-            self.sig_msg.emit(
-                '[!]: Cancelling conversion for "{}".'.format(
-                    self.task_info["basename"]
+        # Send files to the workers in batches, to save a round trip per file, but
+        # keep the batches small enough that every worker has plenty to do:
+        batch_size = len(new_files) // (4 * self.NUM_THREADS)
+        batch_size = max(1, min(self.MAX_BATCH_SIZE, batch_size))
+        for start in range(0, len(new_files), batch_size):
+            batch = new_files[start : start + batch_size]
+            job = (convert_many, batch, self.outputDir, compression_level, use_gpu)
+            try:
+                future = self.pool.submit(*job)
+            except BrokenProcessPool:  # A worker died since the last conversion.
+                self.restartPool()
+                future = self.pool.submit(*job)
+            self.futures[future] = {
+                "basenames": [os.path.basename(fname) for fname in batch],
+                "pool": self.pool,
+            }
+            # The callback runs in one of the pool's threads, so hand it to the GUI
+            # thread with a signal:
+            future.add_done_callback(self.sig_job_done.emit)
+
+        if len(self.futures) > 0:
+            self.indicateThreadsRunning(True)
+        else:
+            self.setStatusBar(
+                "{} Files converted.  You can add more, or exit.".format(
+                    self.convertedCount
                 )
             )
-        self.abort_requested = True
 
 
 def main():
     global app
-    global conversion_serial
-    conversion_serial = 0
     # install exception hook: without this, uncaught exception would cause application to exit
     # sys.excepthook = trap_exc_during_debug
     app = QtWidgets.QApplication(sys.argv)
@@ -646,4 +948,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Needed for the conversion process pool in frozen (PyInstaller) builds:
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,111 @@
+"""
+GPU (CuPy) version of the fused conversion kernel in `conversion_kernels.py`.
+
+CuPy is optional.  The GPU is only used when it is enabled in the config file
+(`use_gpu = true`) and `available()` finds a visible CUDA device.
+"""
+import os
+import numpy as np
+from conversion_kernels import cast_masks
+
+_cupy = None  # the cupy module once imported, or False if it can't be used
+_enabled = True  # False in processes that should leave the GPU to others
+_kernels = None
+
+# Rescale, cast back to the pixel type, then look up in the LUT (if any);
+# matches `_mapped_value` in conversion_kernels.py.
+_RESCALE_LUT_SOURCE = """
+long long x = (long long)(pix * slope + intercept);
+if (mask != 0) {
+    x &= mask;
+    if (x & sign_bit) x -= mask + 1;
+}
+if (lut_len > 0) {
+    long long i = x - first_value;
+    i = i < 0 ? 0 : (i >= lut_len ? lut_len - 1 : i);
+    x = (long long)lut[i];
+    if (mask != 0) {
+        x &= mask;
+        if (x & sign_bit) x -= mask + 1;
+    }
+}
+v = x;
+"""
+
+
+def set_enabled(enabled):
+    """
+    Allow (or stop) this process using the GPU.  Each process that uses it creates
+    its own CUDA context, so a pool of workers should only enable it in a few.
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def available():
+    """
+    Return True if the GPU is enabled in this process, CuPy is installed and a CUDA
+    device is visible (respecting `CUDA_VISIBLE_DEVICES`).  CuPy is only imported
+    the first time this is called, since importing it is slow.
+    """
+    global _cupy
+    if not _enabled:
+        return False
+    if _cupy is None:
+        _cupy = False
+        if os.environ.get("CUDA_VISIBLE_DEVICES", None) in ("", "-1"):
+            return False
+        try:
+            import cupy
+
+            if cupy.cuda.runtime.getDeviceCount() > 0:
+                _cupy = cupy
+        except Exception:  # Not installed, or no usable CUDA driver/device.
+            pass
+    return _cupy is not False
+
+
+def _get_kernels():
+    global _kernels
+    if _kernels is None:
+        rescale_lut = _cupy.ElementwiseKernel(
+            "T pix, float64 slope, float64 intercept, raw L lut, int64 lut_len, "
+            "int64 first_value, int64 mask, int64 sign_bit",
+            "int64 v",
+            _RESCALE_LUT_SOURCE,
+            "dicom_rescale_lut",
+        )
+        normalize = _cupy.ElementwiseKernel(
+            "int64 v, int64 v_min, float64 scale",
+            "uint8 out",
+            "out = (unsigned char)((v - v_min) * scale);",
+            "dicom_normalize_u8",
+        )
+        _kernels = (rescale_lut, normalize)
+    return _kernels
+
+
+def dicom_to_u8(pix, slope, intercept, lut, first_value):
+    """
+    GPU equivalent of `conversion_kernels.dicom_to_u8`: apply rescale
+    slope/intercept and LUT to the 2-D integer image `pix`, then normalize it to
+    8-bit greyscale.  Returns a NumPy array.  Only call this if `available()`.
+    """
+    rescale_lut, normalize = _get_kernels()
+    mask, sign_bit = cast_masks(pix.dtype)
+    lut_len = len(lut)
+    if lut_len == 0:
+        lut = np.zeros(1, dtype=lut.dtype)  # placeholder; never read
+    values = rescale_lut(
+        _cupy.asarray(pix),
+        float(slope),
+        float(intercept),
+        _cupy.asarray(lut),
+        lut_len,
+        int(first_value),
+        mask,
+        sign_bit,
+    )
+    v_min, v_max = int(values.min()), int(values.max())
+    scale = 255.0 / (v_max - v_min) if v_max > v_min else 0.0
+    return _cupy.asnumpy(normalize(values, v_min, scale))